@@ -28,13 +28,22 @@ import ids_peak.ids_peak as ids_peak
 import ids_peak_ipl.ids_peak_ipl as ids_ipl
 import ids_peak.ids_peak_ipl_extension as ids_ipl_extension
 import sys
+from contextlib import nullcontext
 from datetime import datetime
 from time import sleep
 import os
 
 
-def open_camera():
-    """This functions opens the camera and returns a tuple with a flag, device object and device nodemap object."""
+def list_cameras():
+    """This function returns a list with the serial numbers of all connected cameras."""
+    device_manager = ids_peak.DeviceManager.Instance()
+    device_manager.Update()
+    return [descriptor.SerialNumber() for descriptor in device_manager.Devices()]
+
+
+def open_camera(serial_no=None):
+    """This functions opens the camera and returns a tuple with a flag, device object and device nodemap object.
+    :param serial_no: serial number of the camera to open; default = None (the first camera found)"""
     try:
         # Create a DeviceManager object
         device_manager = ids_peak.DeviceManager.Instance()
@@ -50,8 +59,13 @@ def open_camera():
             # for elem in device_manager.Devices():
             #     print(elem.DisplayName())
         
-        # Open the first device
-        device = device_manager.Devices()[0].OpenDevice(ids_peak.DeviceAccessType_Control)
+        # Open the device with the given serial number or the first device
+        descriptors = [descriptor for descriptor in device_manager.Devices()
+                       if serial_no is None or descriptor.SerialNumber() == str(serial_no)]
+        if not descriptors:
+            print(f'No camera with the serial number #{serial_no}!')
+            return False, None, None
+        device = descriptors[0].OpenDevice(ids_peak.DeviceAccessType_Control)
         print('\nOpened Device: ' + device.DisplayName() + '\n')
             
         # Get the node_map of the RemoteDevice
@@ -158,6 +172,31 @@ def set_fps(remote_device_node_map, fps_value):
     print(f'FPS set to {get_fps(remote_device_node_map)}')
 
 
+def set_roi(remote_device_node_map, x, y, width, height):
+    """This function sets the camera region of interest (ROI). Offsets are reset first, so that the new width and height
+are not limited by the previous offsets.
+    :param remote_device_node_map: nodemap for the device
+    :param x: horizontal offset of the ROI in pixels
+    :param y: vertical offset of the ROI in pixels
+    :param width: width of the ROI in pixels
+    :param height: height of the ROI in pixels"""
+    remote_device_node_map.FindNode("OffsetX").SetValue(0)
+    remote_device_node_map.FindNode("OffsetY").SetValue(0)
+    remote_device_node_map.FindNode("Width").SetValue(width)
+    remote_device_node_map.FindNode("Height").SetValue(height)
+    remote_device_node_map.FindNode("OffsetX").SetValue(x)
+    remote_device_node_map.FindNode("OffsetY").SetValue(y)
+    print(f'ROI set to {get_image_size(remote_device_node_map)}')
+
+
+def get_image_size(remote_device_node_map):
+    """This function reads the size of the acquired image (the ROI).
+    :param remote_device_node_map: nodemap for the device
+    :return: a tuple: (width, height) in pixels"""
+    return (remote_device_node_map.FindNode("Width").Value(),
+            remote_device_node_map.FindNode("Height").Value())
+
+
 def set_trigger_parameters(remote_device_node_map):
     """This function sets the camera trigger parameters - software trigger for acquisition of one frame only.
     :param remote_device_node_map: nodemap for the device"""
@@ -230,23 +269,50 @@ def start_acquisition(data_stream, remote_device_node_map):
         return False
 
 
-def acquire_and_save(remote_device_node_map, data_stream, filepath="C:\\Users\\"):
+def acquire_image(remote_device_node_map, data_stream, cpu_limit=None):
+    """This function acquires the image (trigger release) and returns it converted to Mono12. The buffer is queued back
+to the data stream before returning, so the image may be saved later.
+    :param remote_device_node_map: nodemap for the device
+    :param data_stream: camera data streams -  device.DataStreams() type object
+    :param cpu_limit: context manager held during the conversion, e.g. a limit shared by several cameras; default = None
+    :return: Mono12 image (ids_peak_ipl.Image)"""
+    remote_device_node_map.FindNode("TriggerSoftware").Execute()
+    buffer = data_stream.WaitForFinishedBuffer(2000)
+    # convert to Mono image
+    raw_image = ids_ipl_extension.BufferToImage(buffer)
+    with cpu_limit or nullcontext():
+        mono_image = raw_image.ConvertTo(ids_ipl.PixelFormatName_Mono12)
+    data_stream.QueueBuffer(buffer)
+    return mono_image
+
+
+def save_image(image, filepath, filename=None, file_format="png"):
+    """This function saves the image to file.
+    :param image: image to save (ids_peak_ipl.Image)
+    :param filepath: string with filepath to a folder where data will be saved
+    :param filename: file name without extension; default = current date and time
+    :param file_format: file extension, e.g. "png"
+    :return: full path of the saved file"""
+    if not os.path.exists(filepath):
+        os.makedirs(filepath)
+    if filename is None:
+        filename = str(datetime.now().strftime("%d-%m-%Y_%H-%M-%S"))
+    filename = os.path.join(filepath, filename + "." + file_format)
+    ids_ipl.ImageWriter.Write(filename, image)
+    return filename
+
+
+def acquire_and_save(remote_device_node_map, data_stream, filepath="C:\\Users\\", filename=None, file_format="png"):
     """This function acquires the image (trigger release) and saves to file.
     :param remote_device_node_map: nodemap for the device
     :param filepath: string with filepath to a folder where data will be saved; default = "C:\\Users\\"
     :param data_stream: camera data streams -  device.DataStreams() type object
+    :param filename: file name without extension; default = current date and time
+    :param file_format: file extension; default = "png"
     :return: flag (True if successful)"""
     try:
-        if not os.path.exists(filepath):
-            os.mkdir(filepath)
-        remote_device_node_map.FindNode("TriggerSoftware").Execute()
-        buffer = data_stream.WaitForFinishedBuffer(2000)
-        # convert to Mono image
-        raw_image = ids_ipl_extension.BufferToImage(buffer)
-        mono_image = raw_image.ConvertTo(ids_ipl.PixelFormatName_Mono12)
-        data_stream.QueueBuffer(buffer)
-        filename = filepath + str(datetime.now().strftime("%d-%m-%Y_%H-%M-%S")) + ".png"
-        ids_ipl.ImageWriter.Write(filename, mono_image)
+        mono_image = acquire_image(remote_device_node_map, data_stream)
+        save_image(mono_image, filepath, filename, file_format)
         return True
     except Exception as e:
         print("\nEXCEPTION: " + str(e))
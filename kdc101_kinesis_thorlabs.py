@@ -38,6 +38,19 @@ from Thorlabs.MotionControl.KCube.DCServoCLI import *
 from Thorlabs.MotionControl.KCube.InertialMotorCLI import *
 
 
+def kdc101_list_devices():
+    """
+    List the connected KDC101 controllers
+    :return: list of the serial numbers (str) of all connected KCubeDCServo devices
+    """
+    try:
+        DeviceManagerCLI.BuildDeviceList()
+        return [str(serial_no) for serial_no in DeviceManagerCLI.GetDeviceList(KCubeDCServo.DevicePrefix)]
+    except Exception as e:
+        print(e)
+        return []
+
+
 def kdc101_create_dev(serial_no):
     """
     Create a handler to a device
@@ -25,61 +25,151 @@ SOFTWARE.
 
 from kdc101_kinesis_thorlabs import *
 from cam_IDS_U338JxXLEM import *
+from scan_plan import *
+import os
 import time
 
 
+def configure_camera(plan):
+    """
+    Open the camera given in the plan (the first camera found if the plan has no serial_no), apply the plan settings,
+    allocate the buffers and start acquisition.
+    :param plan: scan plan (see scan_plan.load_plan)
+    :return: a tuple: (status (0 if successful, otherwise the exit code), device object, device nodemap object,
+    data stream)
+    """
+    # open camera
+    status, device, remote_device_node_map = open_camera(plan['camera'].get('serial_no'))
+    if not status:
+        return -1, None, None, None
+    # set default parameters - binning, flipping etc
+    set_default_parameters(remote_device_node_map)
+    # check the exposure time against the camera range
+    min_exposure, max_exposure, _ = get_exposure_params(remote_device_node_map)
+    errors = validate_plan(plan, (min_exposure, max_exposure))
+    if errors:
+        print('Invalid scan plan:\n\t' + '\n\t'.join(errors))
+        return -6, device, remote_device_node_map, None
+    # set exposure time
+    set_exposure_time(remote_device_node_map, plan['camera']['exposure_us'])
+    # set gain
+    set_gain(remote_device_node_map, plan['camera']['gain'])
+    # set ROI
+    roi = plan['camera']['roi']
+    if roi is not None:
+        set_roi(remote_device_node_map, roi['x'], roi['y'], roi['width'], roi['height'])
+    # set Trigger parameters
+    set_trigger_parameters(remote_device_node_map)
+    status, data_stream = prepare_acquisition(device)
+    if not status:
+        return -2, device, remote_device_node_map, None
+    if not alloc_and_announce_buffers(data_stream, remote_device_node_map):
+        return -3, device, remote_device_node_map, data_stream
+    # start acquisition
+    if not start_acquisition(data_stream, remote_device_node_map):
+        return -4, device, remote_device_node_map, data_stream
+    return 0, device, remote_device_node_map, data_stream
+
+
+def run_scans(stage, remote_device_node_map, data_stream, plan, scans, timing_log=DEFAULT_TIMING_LOG, limits=None):
+    """
+    Execute the scans: move the stage to the start position of the plan, then to every position of the scans (unless
+    the stage is already there), wait for the stage to settle, acquire and save a burst of frames. The timing of every
+    position is appended to the timing log to calibrate future estimates; time spent waiting for the limits is
+    excluded from the frame duration.
+    :param stage: KCubeDCServo device object
+    :param remote_device_node_map: nodemap for the camera
+    :param data_stream: camera data streams -  device.DataStreams() type object
+    :param plan: scan plan (see scan_plan.load_plan)
+    :param scans: scans in the order they will be executed
+    :param timing_log: path to the timing log
+    :param limits: limits shared with other rigs (see rig_manager.RigLimits); default: None - no limits
+    :return: flag (True if successful)
+    """
+    try:
+        save = save_image if limits is None else limits.save
+        file_format = plan['output']['format']
+        width, height = get_image_size(remote_device_node_map)
+        pos = plan['stage']['start_pos']
+        kdc101_move_to_abs_pos(stage, pos, True)
+        for scan in scans:
+            filepath = os.path.join(plan['output']['path'], scan['name'])
+            burst = int(scan['burst'])
+            for i, z in enumerate(scan_positions(scan)):
+                t_start = time.perf_counter()
+                if z != pos:
+                    kdc101_move_to_abs_pos(stage, z, True)
+                move_s = time.perf_counter() - t_start
+                time.sleep(scan['settle_s'])
+
+                n_bytes = 0
+                if limits is not None:
+                    limits.pop_wait()
+                t_start = time.perf_counter()
+                for k in range(burst):
+                    image = acquire_image(remote_device_node_map, data_stream,
+                                          None if limits is None else limits.cpu())
+                    filename = save(image, filepath, f'{scan["name"]}_{i:04d}_z{z:.4f}mm_{k:02d}', file_format)
+                    n_bytes += os.path.getsize(filename)
+                wait_s = 0.0 if limits is None else limits.pop_wait()
+                frame_s = (time.perf_counter() - t_start - wait_s) / burst
+
+                append_timing_record(timing_log, {'move_mm': abs(z - pos), 'move_s': move_s,
+                                                  'settle_s': scan['settle_s'], 'frames': burst, 'frame_s': frame_s,
+                                                  'wait_s': wait_s,
+                                                  'exposure_us': plan['camera']['exposure_us'],
+                                                  'pixels': width * height, 'bytes': n_bytes,
+                                                  'format': file_format})
+                pos = z
+        return True
+    except Exception as e:
+        print("\nEXCEPTION: " + str(e))
+        return False
+
+
 if __name__ == '__main__':
 
-    # STEPPER MOTOR - positions
-    step = 0.8/1000
-    N = 100
-    SM_init_pos = 5.0
+    args = parse_args()
+    # SCAN PLAN - validation against the stage range and estimate
+    plan = load_plan(args.plan)
+    errors = validate_plan(plan)
+    if errors:
+        print('Invalid scan plan:\n\t' + '\n\t'.join(errors))
+        sys.exit(-6)
+    scans = plan['scans'] if plan['keep_order'] else order_scans(plan['scans'], plan['stage']['start_pos'])
+    records = load_timing_records(args.timing_log)
+    print_estimate(plan, scans, fit_timing_model(records), len(records))
+    if args.dry_run:
+        sys.exit(0)
 
+    serial_no = plan['stage']['serial_no']
+    MyStage = None
+    my_device = None
     try:
         # DEVICES INIT
+        # camera - opened first, so that the plan is checked against the camera before the stage is homed
+        ids_peak.Library.Initialize()
+        status, my_device, my_remote_device_node_map, my_data_stream = configure_camera(plan)
+        if status != 0:
+            sys.exit(status)
+
         # stepper motor
-        MyStage = kdc101_create_dev('27601295')
-        kdc101_init(MyStage, '27601295', homing=True, settings_name='MTS25/M-Z8')
-        kdc101_move_to_abs_pos(MyStage, SM_init_pos, True)
+        MyStage = kdc101_create_dev(serial_no)
+        if MyStage is None:
+            sys.exit(-7)
+        kdc101_init(MyStage, serial_no, homing=plan['stage']['homing'], settings_name=plan['stage']['settings_name'])
         kdc101_get_curr_pos(MyStage, True)
-        time.sleep(1)
 
-        # camera
-        ids_peak.Library.Initialize()
-        # open camera
-        status, my_device, my_remote_device_node_map = open_camera()
-        # set default parameters - binning, flipping etc
-        set_default_parameters(my_remote_device_node_map)
-        # set exposure time
-        set_exposure_time(my_remote_device_node_map, 16004.38)
-        # set gain to 1.0
-        set_gain(my_remote_device_node_map, 1.0)
-        # set Trigger parameters
-        set_trigger_parameters(my_remote_device_node_map)
-        status, my_data_stream = prepare_acquisition(my_device)
-        if not status:
-            sys.exit(-2)
-        if not alloc_and_announce_buffers(my_data_stream, my_remote_device_node_map):
-            sys.exit(-3)
-        # start acquisition
-        if not start_acquisition(my_data_stream, my_remote_device_node_map):
-            sys.exit(-4)
-
-            # FOR LOOP - EXPERIMENT
-        for i in range(N):
-            kdc101_move_to_rel_pos(MyStage, step, True)
-            kdc101_get_curr_pos(MyStage, True)
-            time.sleep(1)
-            # acquire and save an image
-            if not acquire_and_save(my_remote_device_node_map, my_data_stream,  "C:\\Users\\marcinmarzejon\\Documents\\experiment1-2\\"):
-                sys.exit(-5)
-
-        # CLOSE DEVICES -----------------------------
-        kdc101_close(MyStage)
-        my_device = None
-        del my_device
+        # EXPERIMENT
+        if not run_scans(MyStage, my_remote_device_node_map, my_data_stream, plan, scans, args.timing_log):
+            sys.exit(-5)
 
     except Exception as ex:
         print(f"An error occurred!!: {ex}")
     finally:
+        # CLOSE DEVICES -----------------------------
+        if MyStage is not None:
+            kdc101_close(MyStage)
+        my_device = None
+        del my_device
         ids_peak.Library.Close()
@@ -0,0 +1,261 @@
+"""
+MIT License
+
+Copyright (c) 2024 Marcin J Marzejon
+e-mail: marcin.marzejon@pw.edu.pl
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from scan_plan import *
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class DiskThrottle:
+    """
+    Limit of the disk bandwidth shared by all rigs. Every saved frame is charged to a common budget; a rig which
+    exceeded the budget waits before its next frame, so the total write rate stays below the limit.
+    """
+
+    def __init__(self, bytes_per_s=None):
+        """
+        :param bytes_per_s: disk bandwidth limit; None - no limit
+        :type bytes_per_s: float
+        """
+        self.bytes_per_s = bytes_per_s
+        self._lock = threading.Lock()
+        self._next_free = time.monotonic()
+
+    def consume(self, n_bytes):
+        """
+        Charge n_bytes to the budget and wait until they fit into the bandwidth limit.
+        :param n_bytes: number of bytes written
+        :type n_bytes: int
+        :return: None
+        """
+        if not self.bytes_per_s:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next_free, now)
+            self._next_free = start + n_bytes / self.bytes_per_s
+        if start > now:
+            time.sleep(start - now)
+
+
+# keys every rig of the configuration must have
+RIG_KEYS = ('plan', 'camera_serial', 'stage_serial')
+
+
+def rig_name_error(name):
+    """
+    Check the name of a rig, which is used as a folder and file name.
+    :param name: name of the rig
+    :return: description of the problem; None if the name is valid
+    :rtype: str
+    """
+    if not isinstance(name, str) or not name:
+        return f'name must be a non-empty string, got {name!r}'
+    if '/' in name or '\\' in name or '..' in name:
+        return f'name must not contain path separators or "..", got {name!r}'
+    return None
+
+
+def load_rigs(filepath):
+    """
+    Read the rig configuration from a JSON file. Example:
+        {
+            "limits": {"disk_mb_s": 200, "max_writers": 2},
+            "rigs": [
+                {"name": "rig1", "camera_serial": "4108123456", "stage_serial": "27601295", "plan": "plan_rig1.json"},
+                {"name": "rig2", "camera_serial": "4108123457", "stage_serial": "27601296", "plan": "plan_rig2.json"}
+            ]
+        }
+    Every rig pairs a camera and a KDC101 controller with a scan plan (see scan_plan.load_plan); the serial numbers
+    from the rig override the ones in the plan. Frames of every rig are saved to a subfolder named after the rig in the
+    output path of its plan, so rigs sharing a plan do not overwrite each other's files. The limits are shared by all
+    rigs: disk_mb_s - total disk bandwidth in MB/s, max_writers - number of frames converted, encoded and written at
+    the same time (default: number of CPUs - 1). The timing records of every rig are appended to its timing_log
+    (default: scan_timing_<name>.jsonl); like the plan, it is relative to the folder of the configuration file.
+    A rig with an invalid name, which misses one of plan, camera_serial and stage_serial, or whose plan cannot be read,
+    is kept without the loaded plan and reported by validate_rigs, as are limits and rigs of a wrong type. A file which
+    is not a JSON object raises ValueError.
+    :param filepath: path to the JSON file
+    :type filepath: str
+    :return: a tuple: (list of rigs with the loaded plans, limits)
+    :rtype: tuple
+    """
+    with open(filepath) as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError(f'{filepath}: a rig configuration must be a JSON object')
+
+    # limits and rigs of a wrong type are kept as they are and reported by validate_rigs
+    limits = config.get('limits', {})
+    if isinstance(limits, dict):
+        limits.setdefault('disk_mb_s', None)
+        limits.setdefault('max_writers', max((os.cpu_count() or 2) - 1, 1))
+    rigs = config.get('rigs', [])
+    if not isinstance(rigs, list):
+        return rigs, limits
+    config_dir = os.path.dirname(os.path.abspath(filepath))
+    for i, rig in enumerate(rigs):
+        if not isinstance(rig, dict):
+            continue
+        rig.setdefault('name', f'rig{i}')
+        # the name becomes a part of paths - nothing is built from an invalid one
+        if rig_name_error(rig['name']) is not None or any(key not in rig for key in RIG_KEYS):
+            continue
+        # plan and timing log paths are relative to the rig configuration file
+        rig.setdefault('timing_log', f'scan_timing_{rig["name"]}.jsonl')
+        if isinstance(rig['timing_log'], str):
+            rig['timing_log'] = os.path.join(config_dir, rig['timing_log'])
+        if not isinstance(rig['plan'], str):
+            rig['plan_error'] = f'plan must be a file name, got {rig["plan"]!r}'
+            continue
+        try:
+            rig['plan'] = load_plan(os.path.join(config_dir, rig['plan']))
+        except (OSError, ValueError) as e:
+            rig['plan_error'] = str(e)
+            continue
+        rig['plan']['stage']['serial_no'] = str(rig['stage_serial'])
+        rig['plan']['camera']['serial_no'] = str(rig['camera_serial'])
+        if rig['plan']['output'].get('path'):
+            rig['plan']['output']['path'] = os.path.join(rig['plan']['output']['path'], rig['name'])
+    return rigs, limits
+
+
+def validate_rigs(rigs, limits, cameras=None, stages=None):
+    """
+    Check the plans of all rigs, the pairing of the devices and the global limits.
+    :param rigs: rigs (see load_rigs)
+    :type rigs: list
+    :param limits: limits shared by all rigs (see load_rigs)
+    :type limits: dict
+    :param cameras: serial numbers of the connected cameras; None - not checked
+    :type cameras: list
+    :param stages: serial numbers of the connected KDC101 controllers; None - not checked
+    :type stages: list
+    :return: list of problems found; empty if the configuration is valid
+    :rtype: list
+    """
+    errors = []
+    if not isinstance(limits, dict):
+        errors.append(f'limits must be an object, got {limits!r}')
+    else:
+        disk_mb_s = limits['disk_mb_s']
+        if disk_mb_s is not None and (not is_number(disk_mb_s) or disk_mb_s <= 0):
+            errors.append(f'limits: disk_mb_s must be a positive number or null, got {disk_mb_s!r}')
+        max_writers = limits['max_writers']
+        if not is_number(max_writers, integer=True) or max_writers < 1:
+            errors.append(f'limits: max_writers must be a positive integer, got {max_writers!r}')
+    if not isinstance(rigs, list):
+        return errors + [f'rigs must be a list, got {rigs!r}']
+    if not rigs:
+        errors.append('no rigs')
+    for i, rig in enumerate(rigs):
+        if not isinstance(rig, dict):
+            errors.append(f'rig {i}: must be an object, got {rig!r}')
+    rigs = [rig for rig in rigs if isinstance(rig, dict)]
+    for key in ('name', 'camera_serial', 'stage_serial'):
+        values = [str(rig[key]) for rig in rigs if key in rig]
+        for value in set(values):
+            if values.count(value) > 1:
+                errors.append(f'{key} {value} used by more than one rig')
+    for rig in rigs:
+        name_error = rig_name_error(rig['name'])
+        if name_error is not None:
+            errors.append(f'rig {rig["name"]!r}: {name_error}')
+            continue
+        missing = [key for key in RIG_KEYS if key not in rig]
+        if missing:
+            errors.append(f'{rig["name"]}: missing {", ".join(missing)}')
+            continue
+        if 'plan_error' in rig:
+            errors.append(f'{rig["name"]}: cannot read the plan: {rig["plan_error"]}')
+            continue
+        if not isinstance(rig['timing_log'], str):
+            errors.append(f'{rig["name"]}: timing_log must be a file name, got {rig["timing_log"]!r}')
+        errors += [f'{rig["name"]}: {error}' for error in validate_plan(rig['plan'])]
+        if cameras is not None and str(rig['camera_serial']) not in cameras:
+            errors.append(f'{rig["name"]}: camera #{rig["camera_serial"]} not connected')
+        if stages is not None and str(rig['stage_serial']) not in stages:
+            errors.append(f'{rig["name"]}: KDC101 #{rig["stage_serial"]} not connected')
+    return errors
+
+
+class RigLimits:
+    """
+    Limits shared by all rigs: the number of frames converted, encoded and written at the same time (the CPU limit) and
+    the disk bandwidth. The time each worker thread waits for the limits is recorded, so that it can be excluded from
+    its timing records.
+    """
+
+    def __init__(self, save, max_writers, bytes_per_s=None):
+        """
+        :param save: function saving a frame (see save_image)
+        :param max_writers: number of frames converted, encoded and written at the same time
+        :type max_writers: int
+        :param bytes_per_s: disk bandwidth limit; None - no limit
+        :type bytes_per_s: float
+        """
+        self._save = save
+        self._writers = threading.BoundedSemaphore(max_writers)
+        self._throttle = DiskThrottle(bytes_per_s)
+        self._local = threading.local()
+
+    def _add_wait(self, seconds):
+        self._local.wait_s = getattr(self._local, 'wait_s', 0.0) + seconds
+
+    def pop_wait(self):
+        """
+        Return the time the calling worker thread waited for the limits since the last call and reset it.
+        :return: time in seconds
+        :rtype: float
+        """
+        wait_s = getattr(self._local, 'wait_s', 0.0)
+        self._local.wait_s = 0.0
+        return wait_s
+
+    @contextlib.contextmanager
+    def cpu(self):
+        """
+        Context manager holding one of the max_writers slots, for the conversion (see acquire_image) and encoding of a
+        frame.
+        """
+        t_start = time.perf_counter()
+        with self._writers:
+            self._add_wait(time.perf_counter() - t_start)
+            yield
+
+    def save(self, image, filepath, filename=None, file_format="png"):
+        """
+        Save the image with the save function (see save_image) within the limits.
+        :return: full path of the saved file
+        """
+        with self.cpu():
+            filename = self._save(image, filepath, filename, file_format)
+        t_start = time.perf_counter()
+        self._throttle.consume(os.path.getsize(filename))
+        self._add_wait(time.perf_counter() - t_start)
+        return filename
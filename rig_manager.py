@@ -0,0 +1,179 @@
+"""
+MIT License
+
+Copyright (c) 2024 Marcin J Marzejon
+e-mail: marcin.marzejon@pw.edu.pl
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+from main import *
+from rig_config import *
+import argparse
+import threading
+import time
+
+
+def run_rig(rig, limits, stages_ready):
+    """
+    Worker of a single rig: initialize the stage and execute the scans of the rig plan. The scans start when the stages
+    of all rigs are initialized, so the homing is not a part of the acquisition time. The result is stored in
+    rig['status'] (True if successful), the number of acquired frames in rig['frames'] and the start and the end of the
+    acquisition (time.perf_counter) in rig['t_start'] and rig['t_end'].
+    :param rig: rig with an open camera (see open_rigs)
+    :type rig: dict
+    :param limits: limits shared by all rigs
+    :type limits: RigLimits
+    :param stages_ready: barrier shared by the workers of all rigs
+    :type stages_ready: threading.Barrier
+    :return: None
+    """
+    plan = rig['plan']
+    try:
+        kdc101_init(rig['stage'], plan['stage']['serial_no'], homing=plan['stage']['homing'],
+                    settings_name=plan['stage']['settings_name'])
+    except Exception as e:
+        print(f"\n{rig['name']} EXCEPTION: " + str(e))
+        return
+    finally:
+        # a rig whose stage failed still passes the barrier, so the other rigs do not wait for it forever
+        stages_ready.wait()
+    rig['t_start'] = time.perf_counter()
+    try:
+        rig['status'] = run_scans(rig['stage'], rig['node_map'], rig['data_stream'], plan, rig['scans'],
+                                  rig['timing_log'], limits)
+        if rig['status']:
+            rig['frames'] = sum(len(scan_positions(scan)) * int(scan['burst']) for scan in rig['scans'])
+    except Exception as e:
+        print(f"\n{rig['name']} EXCEPTION: " + str(e))
+    rig['t_end'] = time.perf_counter()
+
+
+def open_rigs(rigs):
+    """
+    Create the stage handlers and open, configure and start the cameras of all rigs, one after another. Every camera
+    gets its own data stream and buffers.
+    :param rigs: rigs (see load_rigs)
+    :type rigs: list
+    :return: flag (True if all devices were opened)
+    """
+    for rig in rigs:
+        rig['stage'] = kdc101_create_dev(rig['plan']['stage']['serial_no'])
+        if rig['stage'] is None:
+            return False
+        status, rig['device'], rig['node_map'], rig['data_stream'] = configure_camera(rig['plan'])
+        if status != 0:
+            print(f"{rig['name']}: camera initialization failed ({status})")
+            return False
+    return True
+
+
+def close_rigs(rigs):
+    """
+    Close the stages and cameras of all rigs.
+    :param rigs: rigs (see open_rigs)
+    :type rigs: list
+    :return: None
+    """
+    for rig in rigs:
+        if rig.get('stage') is not None:
+            kdc101_close(rig['stage'])
+        rig['device'] = None
+
+
+def parse_rig_args(argv=None):
+    """Parse the command line arguments of the rig manager."""
+    parser = argparse.ArgumentParser(description='Lensless microscope - several camera and stage pairs')
+    parser.add_argument('config', nargs='?', help='rig configuration (JSON file)')
+    parser.add_argument('--list', action='store_true', help='list the connected cameras and KDC101 controllers')
+    parser.add_argument('--dry-run', action='store_true', help='validate and estimate the plans only')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+
+    args = parse_rig_args()
+    if args.list or args.config is None:
+        ids_peak.Library.Initialize()
+        try:
+            print(f'Cameras: {", ".join(list_cameras())}')
+        finally:
+            ids_peak.Library.Close()
+        print(f'KDC101: {", ".join(kdc101_list_devices())}')
+        sys.exit(0)
+
+    try:
+        rigs, limits = load_rigs(args.config)
+    except (OSError, ValueError) as e:
+        print(f'Cannot read the rig configuration: {e}')
+        sys.exit(-6)
+    errors = validate_rigs(rigs, limits)
+    if errors:
+        print('Invalid rig configuration:\n\t' + '\n\t'.join(errors))
+        sys.exit(-6)
+    for rig in rigs:
+        plan = rig['plan']
+        rig['scans'] = plan['scans'] if plan['keep_order'] else order_scans(plan['scans'], plan['stage']['start_pos'])
+        records = load_timing_records(rig['timing_log'])
+        print(f'\n{rig["name"]} (camera #{rig["camera_serial"]}, KDC101 #{rig["stage_serial"]})')
+        print_estimate(plan, rig['scans'], fit_timing_model(records), len(records))
+    if args.dry_run:
+        sys.exit(0)
+
+    try:
+        ids_peak.Library.Initialize()
+        errors = validate_rigs(rigs, limits, list_cameras(), kdc101_list_devices())
+        if errors:
+            print('Invalid rig configuration:\n\t' + '\n\t'.join(errors))
+            sys.exit(-6)
+        if not open_rigs(rigs):
+            sys.exit(-1)
+
+        # EXPERIMENT - one worker per rig
+        rig_limits = RigLimits(save_image, limits['max_writers'],
+                               limits['disk_mb_s'] * 1e6 if limits['disk_mb_s'] else None)
+        stages_ready = threading.Barrier(len(rigs))
+        workers = [threading.Thread(target=run_rig, args=(rig, rig_limits, stages_ready), name=rig['name'])
+                   for rig in rigs]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        # acquisition time only - from the end of the stage initialization to the end of the last rig
+        started = [rig for rig in rigs if 't_start' in rig]
+        for rig in rigs:
+            if rig.get('status'):
+                rig_duration = rig['t_end'] - rig['t_start']
+                print(f"{rig['name']}: done, {rig['frames']} frames in {rig_duration:.1f} s "
+                      f"({rig['frames'] / rig_duration:.2f} frames/s)")
+            else:
+                print(f"{rig['name']}: FAILED")
+        if started:
+            frames = sum(rig.get('frames', 0) for rig in rigs)
+            duration = max(rig['t_end'] for rig in started) - min(rig['t_start'] for rig in started)
+            print(f'{frames} frames in {duration:.1f} s ({frames / duration:.2f} frames/s)')
+        if not all(rig.get('status') for rig in rigs):
+            sys.exit(-5)
+
+    except Exception as ex:
+        print(f"An error occurred!!: {ex}")
+    finally:
+        close_rigs(rigs)
+        ids_peak.Library.Close()
@@ -0,0 +1,552 @@
+"""
+MIT License
+
+Copyright (c) 2024 Marcin J Marzejon
+e-mail: marcin.marzejon@pw.edu.pl
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+
+# stage travel range in millimeters - the same limits as in kdc101_move_to_abs_pos
+STAGE_POS_MIN = 0.0
+STAGE_POS_MAX = 25.0
+# stage position after homing
+STAGE_HOME_POS = 0.0
+
+# formats written by ids_peak_ipl.ImageWriter for Mono12 images
+OUTPUT_FORMATS = ('png', 'bmp')
+
+# full sensor size of the IDS U3-38J0XLE-M camera; used when the plan has no ROI
+SENSOR_WIDTH = 3840
+SENSOR_HEIGHT = 2160
+
+# timing model used when there are no past runs to calibrate on
+DEFAULT_TIMING_MODEL = {
+    'move_overhead_s': 0.3,     # fixed cost of a single MoveTo call
+    'move_speed_mm_s': 2.3,     # MTS25/M-Z8 maximum velocity is 2.4 mm/s
+    'frame_overhead_s': 0.25,   # trigger, readout, conversion and writing of a single frame (exposure excluded)
+    'bytes_per_pixel': {'png': 1.5, 'bmp': 2.0},
+}
+
+# maximum number of positions of a single scan - protects from mistyped ranges
+MAX_SCAN_POSITIONS = 100000
+
+# plans with more scans than this are ordered with the nearest-neighbour heuristic instead of the exact search
+MAX_EXACT_ORDERING = 12
+
+DEFAULT_TIMING_LOG = 'scan_timing.jsonl'
+
+# numeric values every timing record must have to be used for calibration (see append_timing_record)
+TIMING_RECORD_KEYS = ('move_mm', 'move_s', 'frames', 'frame_s', 'exposure_us', 'pixels', 'bytes')
+
+
+def load_plan(filepath):
+    """
+    Read a scan plan from a JSON file and fill in the default values. Example of a plan:
+        {
+            "stage": {"serial_no": "27601295", "settings_name": "MTS25/M-Z8", "homing": true},
+            "camera": {"exposure_us": 16004.38, "gain": 1.0, "roi": {"x": 0, "y": 0, "width": 2048, "height": 2048}},
+            "output": {"path": "C:\\\\data\\\\experiment1\\\\", "format": "png"},
+            "scans": [
+                {"name": "coarse", "start": 5.0, "step": 0.0008, "n": 100},
+                {"name": "focus", "z": [7.1, 7.15, 7.3], "burst": 5, "settle_s": 0.5}
+            ]
+        }
+    A scan is either a range ("start", "step" and "n" or "stop") or a list of positions ("z"). The stage is moved to
+    "start_pos" in the stage section before the first scan; it defaults to 0 with homing and is required without
+    homing, when the position of the stage is unknown. All positions are in millimeters, the exposure time in
+    microseconds. A file which is not an object with object sections and a list of scans raises ValueError.
+    :param filepath: path to the JSON file
+    :type filepath: str
+    :return: scan plan
+    :rtype: dict
+    """
+    with open(filepath) as f:
+        plan = json.load(f)
+
+    # the defaults below need the structure - the values themselves are checked by validate_plan
+    if not isinstance(plan, dict):
+        raise ValueError(f'{filepath}: a plan must be a JSON object')
+    for key in ('stage', 'camera', 'output'):
+        if not isinstance(plan.setdefault(key, {}), dict):
+            raise ValueError(f'{filepath}: {key} must be a JSON object')
+    if not isinstance(plan.setdefault('scans', []), list) or not all(isinstance(scan, dict) for scan in plan['scans']):
+        raise ValueError(f'{filepath}: scans must be a list of JSON objects')
+
+    plan['stage'].setdefault('settings_name', 'MTS25/M-Z8')
+    plan['stage'].setdefault('homing', True)
+    # position of the stage before the first scan - 0 after homing, unknown without homing
+    plan['stage'].setdefault('start_pos', 0.0 if plan['stage']['homing'] else None)
+    plan['camera'].setdefault('gain', 1.0)
+    plan['camera'].setdefault('roi', None)
+    plan['output'].setdefault('format', 'png')
+    plan.setdefault('keep_order', False)
+    for i, scan in enumerate(plan['scans']):
+        scan.setdefault('name', f'scan{i:02d}')
+        scan.setdefault('burst', 1)
+        scan.setdefault('settle_s', 1.0)
+    return plan
+
+
+def initial_position(plan):
+    """
+    Position of the stage before it is moved to start_pos - the home position with homing, start_pos otherwise.
+    :param plan: scan plan
+    :type plan: dict
+    :return: position in millimeters
+    :rtype: float
+    """
+    return STAGE_HOME_POS if plan['stage']['homing'] else plan['stage']['start_pos']
+
+
+def scan_positions(scan):
+    """
+    Return the list of stage positions of a single scan.
+    :param scan: a scan from the plan
+    :type scan: dict
+    :return: positions in millimeters, in acquisition order
+    :rtype: list
+    """
+    if 'z' in scan:
+        return [float(z) for z in scan['z']]
+    start = float(scan['start'])
+    step = float(scan['step'])
+    if 'n' in scan:
+        n = int(scan['n'])
+    else:
+        n = int(round((float(scan['stop']) - start) / step)) + 1
+    # rounding to 1 nm removes the floating point error accumulated in start + i*step
+    return [round(start + i * step, 6) for i in range(n)]
+
+
+def is_number(value, integer=False):
+    """
+    Check if a value read from a plan is a number (JSON booleans and strings are not).
+    :param value: value to check
+    :param integer: accept integers only
+    :type integer: bool
+    :return: True if the value is a number
+    :rtype: bool
+    """
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, int) if integer else isinstance(value, (int, float))
+
+
+def scan_range_errors(scan):
+    """
+    Check the positions of a single scan before they are generated: "z" must be a list of numbers, "start", "step"
+    and "stop" numbers and "n" an integer, and the scan must not have more than MAX_SCAN_POSITIONS positions.
+    :param scan: a scan from the plan
+    :type scan: dict
+    :return: list of problems found; empty if scan_positions can be called
+    :rtype: list
+    """
+    if 'z' in scan:
+        if not isinstance(scan['z'], list) or not all(is_number(z) for z in scan['z']):
+            return [f'z must be a list of numbers, got {scan["z"]!r}']
+        n = len(scan['z'])
+    elif 'start' not in scan or 'step' not in scan or ('n' not in scan and 'stop' not in scan):
+        return ['a scan needs either "z" or "start", "step" and "n" (or "stop")']
+    else:
+        errors = [f'{key} must be a number, got {scan[key]!r}' for key in ('start', 'step', 'stop')
+                  if key in scan and not is_number(scan[key])]
+        if 'n' in scan and not is_number(scan['n'], integer=True):
+            errors.append(f'n must be an integer, got {scan["n"]!r}')
+        if errors:
+            return errors
+        if 'n' in scan:
+            n = scan['n']
+        elif scan['step'] == 0:
+            return ['step must not be 0']
+        else:
+            n = int(round((scan['stop'] - scan['start']) / scan['step'])) + 1
+    if n > MAX_SCAN_POSITIONS:
+        return [f'{n} positions, more than {MAX_SCAN_POSITIONS}']
+    return []
+
+
+def validate_plan(plan, exposure_range=None):
+    """
+    Check the plan against the stage travel range and, if given, the camera exposure range.
+    :param plan: scan plan (see load_plan)
+    :type plan: dict
+    :param exposure_range: (minimum, maximum) exposure time in microseconds, as returned by get_exposure_params
+    :type exposure_range: tuple
+    :return: list of problems found; empty if the plan is valid
+    :rtype: list
+    """
+    errors = []
+    if not plan['stage'].get('serial_no'):
+        errors.append('stage: no serial_no')
+    start_pos = plan['stage']['start_pos']
+    if start_pos is None:
+        errors.append('stage: start_pos is required when homing is false')
+    elif not is_number(start_pos):
+        errors.append(f'stage: start_pos must be a number, got {start_pos!r}')
+    elif not STAGE_POS_MIN <= start_pos <= STAGE_POS_MAX:
+        errors.append(f'stage: start_pos {start_pos} outside {STAGE_POS_MIN}-{STAGE_POS_MAX} mm')
+
+    exposure = plan['camera'].get('exposure_us')
+    if exposure is None:
+        errors.append('camera: no exposure_us')
+    elif not is_number(exposure):
+        errors.append(f'camera: exposure_us must be a number, got {exposure!r}')
+    elif exposure <= 0:
+        errors.append(f'camera: exposure_us {exposure} must be positive')
+    elif exposure_range is not None and not exposure_range[0] <= exposure <= exposure_range[1]:
+        errors.append(f'camera: exposure_us {exposure} outside camera range '
+                      f'{exposure_range[0]}-{exposure_range[1]} us')
+    if not is_number(plan['camera']['gain']):
+        errors.append(f'camera: gain must be a number, got {plan["camera"]["gain"]!r}')
+
+    roi = plan['camera']['roi']
+    if roi is not None:
+        try:
+            x, y, width, height = (roi[k] for k in ('x', 'y', 'width', 'height'))
+            if not all(is_number(value, integer=True) for value in (x, y, width, height)):
+                raise TypeError
+            if x < 0 or y < 0 or width <= 0 or height <= 0:
+                errors.append(f'camera: invalid roi {roi}')
+            elif x + width > SENSOR_WIDTH or y + height > SENSOR_HEIGHT:
+                errors.append(f'camera: roi {roi} exceeds the sensor size {SENSOR_WIDTH}x{SENSOR_HEIGHT}')
+        except (KeyError, TypeError, ValueError):
+            errors.append(f'camera: roi must have integer x, y, width and height, got {roi}')
+
+    if not plan['output'].get('path'):
+        errors.append('output: no path')
+    if plan['output']['format'] not in OUTPUT_FORMATS:
+        errors.append(f'output: format {plan["output"]["format"]} not in {OUTPUT_FORMATS}')
+
+    if not plan['scans']:
+        errors.append('scans: the plan has no scans')
+    names = [scan['name'] for scan in plan['scans']]
+    for name in set(names):
+        if names.count(name) > 1:
+            errors.append(f'scans: duplicated name {name}')
+    for scan in plan['scans']:
+        range_errors = scan_range_errors(scan)
+        if range_errors:
+            errors += [f'{scan["name"]}: {error}' for error in range_errors]
+            continue
+        positions = scan_positions(scan)
+        if not positions:
+            errors.append(f'{scan["name"]}: no positions')
+        outside = [z for z in positions if not STAGE_POS_MIN <= z <= STAGE_POS_MAX]
+        if outside:
+            errors.append(f'{scan["name"]}: {len(outside)} position(s) outside {STAGE_POS_MIN}-{STAGE_POS_MAX} mm, '
+                          f'e.g. {outside[0]}')
+        if not is_number(scan['burst'], integer=True):
+            errors.append(f'{scan["name"]}: burst must be an integer, got {scan["burst"]!r}')
+        elif scan['burst'] < 1:
+            errors.append(f'{scan["name"]}: burst must be at least 1')
+        if not is_number(scan['settle_s']):
+            errors.append(f'{scan["name"]}: settle_s must be a number, got {scan["settle_s"]!r}')
+        elif scan['settle_s'] < 0:
+            errors.append(f'{scan["name"]}: settle_s must not be negative')
+    return errors
+
+
+def scan_endpoints(scan):
+    """
+    First and last position of a scan and the stage travel within the scan, which does not depend on the scan order.
+    :param scan: a scan from the plan
+    :type scan: dict
+    :return: a tuple: (first position, last position, travel in millimeters)
+    :rtype: tuple
+    """
+    positions = scan_positions(scan)
+    travel = sum(abs(z1 - z0) for z0, z1 in zip(positions, positions[1:]))
+    return positions[0], positions[-1], travel
+
+
+def endpoints_travel(endpoints, start_pos):
+    """
+    Total stage travel of scans given by their endpoints (see scan_endpoints), executed in the given order.
+    :param endpoints: endpoints of the scans
+    :type endpoints: list
+    :param start_pos: stage position before the first scan in millimeters
+    :type start_pos: float
+    :return: travel in millimeters
+    :rtype: float
+    """
+    travel = 0.0
+    pos = start_pos
+    for first, last, inner in endpoints:
+        travel += abs(first - pos) + inner
+        pos = last
+    return travel
+
+
+def scans_travel(scans, start_pos):
+    """
+    Total stage travel of the scans executed in the given order.
+    :param scans: scans from the plan
+    :type scans: list
+    :param start_pos: stage position before the first scan in millimeters
+    :type start_pos: float
+    :return: travel in millimeters
+    :rtype: float
+    """
+    return endpoints_travel([scan_endpoints(scan) for scan in scans], start_pos)
+
+
+def order_scans(scans, start_pos):
+    """
+    Reorder the scans to minimize the total stage travel. The positions within a scan keep their order, so only the
+    jumps between the scans depend on the order. For up to MAX_EXACT_ORDERING scans the optimal order is found by
+    dynamic programming over subsets of scans, otherwise the nearest scan is taken next.
+    :param scans: scans from the plan
+    :type scans: list
+    :param start_pos: stage position before the first scan in millimeters
+    :type start_pos: float
+    :return: reordered scans
+    :rtype: list
+    """
+    if not scans:
+        return []
+    endpoints = [scan_endpoints(scan) for scan in scans]
+    n = len(scans)
+    if n <= MAX_EXACT_ORDERING:
+        # best[(subset, last)] - (travel between the scans, previous scan) of the best path through the subset
+        # (bit mask) which ends with the scan last
+        best = {(1 << i, i): (abs(endpoints[i][0] - start_pos), None) for i in range(n)}
+        for subset in range(1, 1 << n):
+            for last in range(n):
+                if (subset, last) not in best:
+                    continue
+                travel = best[(subset, last)][0]
+                for nxt in range(n):
+                    if subset & (1 << nxt):
+                        continue
+                    key = (subset | (1 << nxt), nxt)
+                    candidate = travel + abs(endpoints[nxt][0] - endpoints[last][1])
+                    if key not in best or candidate < best[key][0]:
+                        best[key] = (candidate, last)
+        full = (1 << n) - 1
+        last = min(range(n), key=lambda i: best[(full, i)][0])
+        order = []
+        subset = full
+        while last is not None:
+            order.append(last)
+            subset, last = subset & ~(1 << last), best[(subset, last)][1]
+        return [scans[i] for i in reversed(order)]
+
+    remaining = list(range(n))
+    order = []
+    pos = start_pos
+    while remaining:
+        i = min(remaining, key=lambda j: abs(endpoints[j][0] - pos))
+        remaining.remove(i)
+        order.append(i)
+        pos = endpoints[i][1]
+    return [scans[i] for i in order]
+
+
+def load_timing_records(filepath):
+    """
+    Read the timing records of past runs (one JSON object per line, see append_timing_record). Lines which cannot be
+    parsed (e.g. written by an interrupted run) or miss some values are skipped with a warning.
+    :param filepath: path to the timing log
+    :type filepath: str
+    :return: list of records; empty if the log does not exist
+    :rtype: list
+    """
+    records = []
+    if not os.path.exists(filepath):
+        return records
+    skipped = []
+    with open(filepath) as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                skipped.append(line_no)
+                continue
+            if (not isinstance(record, dict) or not isinstance(record.get('format'), str)
+                    or not all(is_number(record.get(key)) for key in TIMING_RECORD_KEYS)):
+                skipped.append(line_no)
+                continue
+            records.append(record)
+    if skipped:
+        print(f'WARNING: skipped {len(skipped)} invalid line(s) of {filepath}: {", ".join(map(str, skipped[:10]))}'
+              f'{", ..." if len(skipped) > 10 else ""}')
+    return records
+
+
+def append_timing_record(filepath, record):
+    """
+    Append the timing record of a single stage position to the timing log. The record holds: move_mm (travel to the
+    position), move_s (duration of the move), settle_s, frames (number of frames acquired), frame_s (mean duration of
+    acquiring and writing a frame), wait_s (time spent waiting for the limits shared with other rigs, not included in
+    frame_s), exposure_us, pixels (per frame), bytes (written in total) and format.
+    :param filepath: path to the timing log
+    :type filepath: str
+    :param record: timing record
+    :type record: dict
+    :return: None
+    """
+    with open(filepath, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+def fit_timing_model(records):
+    """
+    Calibrate the timing model on records of past runs. The move time is fitted as move_overhead_s +
+    move_mm/move_speed_mm_s (least squares), the frame overhead is the mean frame duration minus the exposure time, and
+    bytes per pixel are averaged per output format. Values which cannot be fitted are taken from DEFAULT_TIMING_MODEL.
+    :param records: timing records (see append_timing_record)
+    :type records: list
+    :return: timing model
+    :rtype: dict
+    """
+    model = dict(DEFAULT_TIMING_MODEL)
+    model['bytes_per_pixel'] = dict(DEFAULT_TIMING_MODEL['bytes_per_pixel'])
+
+    moves = [(r['move_mm'], r['move_s']) for r in records if r['move_mm'] > 0]
+    if moves:
+        n = len(moves)
+        mean_d = sum(d for d, _ in moves) / n
+        mean_t = sum(t for _, t in moves) / n
+        var_d = sum((d - mean_d) ** 2 for d, _ in moves)
+        slope = sum((d - mean_d) * (t - mean_t) for d, t in moves) / var_d if var_d > 0 else 0.0
+        if slope > 0:
+            model['move_speed_mm_s'] = 1.0 / slope
+            model['move_overhead_s'] = max(mean_t - slope * mean_d, 0.0)
+        else:
+            # all moves of the same length - keep the default speed and fit the overhead only
+            model['move_overhead_s'] = max(mean_t - mean_d / model['move_speed_mm_s'], 0.0)
+
+    frames = [r for r in records if r['frames'] > 0]
+    if frames:
+        model['frame_overhead_s'] = max(sum(r['frame_s'] - r['exposure_us'] / 1e6 for r in frames) / len(frames), 0.0)
+
+    for file_format in {r['format'] for r in frames}:
+        written = [r for r in frames if r['format'] == file_format and r['pixels'] > 0]
+        pixels = sum(r['pixels'] * r['frames'] for r in written)
+        if pixels > 0:
+            model['bytes_per_pixel'][file_format] = sum(r['bytes'] for r in written) / pixels
+    return model
+
+
+def frame_pixels(plan):
+    """
+    Number of pixels of a single frame - the ROI if given, the full sensor otherwise.
+    :param plan: scan plan
+    :type plan: dict
+    :return: number of pixels
+    :rtype: int
+    """
+    roi = plan['camera']['roi']
+    if roi is None:
+        return SENSOR_WIDTH * SENSOR_HEIGHT
+    return int(roi['width']) * int(roi['height'])
+
+
+def estimate_plan(plan, scans, model):
+    """
+    Estimate the duration and disk usage of the scans, including the move to start_pos (device initialisation and
+    homing excluded). As in run_scans, the stage is not moved to a position it is already at.
+    :param plan: scan plan
+    :type plan: dict
+    :param scans: scans in the order they will be executed
+    :type scans: list
+    :param model: timing model (see fit_timing_model)
+    :type model: dict
+    :return: a tuple: (duration in seconds, disk usage in bytes, number of frames, stage travel in millimeters)
+    :rtype: tuple
+    """
+    bytes_per_pixel = model['bytes_per_pixel'].get(plan['output']['format'],
+                                                   DEFAULT_TIMING_MODEL['bytes_per_pixel']['png'])
+    frame_s = plan['camera']['exposure_us'] / 1e6 + model['frame_overhead_s']
+    duration = 0.0
+    travel = 0.0
+    n_frames = 0
+    pos = initial_position(plan)
+    # the move to start_pos is followed by the positions of the scans
+    positions = itertools.chain([(plan['stage']['start_pos'], None)],
+                                ((z, scan) for scan in scans for z in scan_positions(scan)))
+    for z, scan in positions:
+        if z != pos:
+            duration += model['move_overhead_s'] + abs(z - pos) / model['move_speed_mm_s']
+            travel += abs(z - pos)
+        if scan is not None:
+            duration += scan['settle_s'] + int(scan['burst']) * frame_s
+            n_frames += int(scan['burst'])
+        pos = z
+    return duration, n_frames * frame_pixels(plan) * bytes_per_pixel, n_frames, travel
+
+
+def print_estimate(plan, scans, model, n_records=0):
+    """
+    Print the execution order, the stage travel and the duration and disk usage estimate of the plan.
+    :param plan: scan plan
+    :param scans: scans in the order they will be executed
+    :param model: timing model (see fit_timing_model)
+    :param n_records: number of timing records the model was calibrated on
+    :return: None
+    """
+    duration, disk_usage, n_frames, travel = estimate_plan(plan, scans, model)
+    start_pos = plan['stage']['start_pos']
+    plan_travel = abs(start_pos - initial_position(plan)) + scans_travel(plan['scans'], start_pos)
+    print(f'Scan order: {", ".join(scan["name"] for scan in scans)}')
+    print(f'Stage travel: {travel:.3f} mm (plan order: {plan_travel:.3f} mm)')
+    hours, rest = divmod(int(round(duration)), 3600)
+    print(f'Frames: {n_frames}')
+    print(f'Estimated duration: {hours}h {rest // 60:02d}min {rest % 60:02d}s '
+          f'(timing model calibrated on {n_records} record(s))')
+    print(f'Estimated disk usage: {disk_usage / 1e9:.2f} GB')
+
+
+def parse_args(argv=None):
+    """Parse the command line arguments shared by the scan plan tools."""
+    parser = argparse.ArgumentParser(description='Lensless microscope scan plan')
+    parser.add_argument('plan', help='scan plan (JSON file)')
+    parser.add_argument('--timing-log', default=DEFAULT_TIMING_LOG,
+                        help=f'timing records of past runs used to calibrate the estimates; default: '
+                             f'{DEFAULT_TIMING_LOG}')
+    parser.add_argument('--dry-run', action='store_true', help='validate and estimate the plan only')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Validate the plan and print the estimate without connecting to any device."""
+    args = parse_args(argv)
+    plan = load_plan(args.plan)
+    errors = validate_plan(plan)
+    if errors:
+        print('Invalid scan plan:\n\t' + '\n\t'.join(errors))
+        return -1
+    scans = plan['scans'] if plan['keep_order'] else order_scans(plan['scans'], plan['stage']['start_pos'])
+    records = load_timing_records(args.timing_log)
+    print_estimate(plan, scans, fit_timing_model(records), len(records))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
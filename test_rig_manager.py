@@ -0,0 +1,155 @@
+"""
+Tests of the rig manager functions which do not need any device (rig_config). Run with: python -m pytest
+"""
+
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from rig_config import *
+
+PLAN = {
+    'stage': {'serial_no': '0'},
+    'camera': {'exposure_us': 16000.0},
+    'output': {'path': 'data'},
+    'scans': [{'name': 'coarse', 'start': 5.0, 'step': 0.0008, 'n': 10}],
+}
+
+
+def make_config(tmp_path, rigs, limits=None):
+    """Write a plan and a rig configuration using it and load the configuration with load_rigs."""
+    (tmp_path / 'plan.json').write_text(json.dumps(PLAN))
+    config = {'rigs': rigs}
+    if limits is not None:
+        config['limits'] = limits
+    (tmp_path / 'rigs.json').write_text(json.dumps(config))
+    return load_rigs(str(tmp_path / 'rigs.json'))
+
+
+def make_rig(name, serial):
+    return {'name': name, 'camera_serial': f'41{serial}', 'stage_serial': f'27{serial}', 'plan': 'plan.json'}
+
+
+def test_load_rigs_pairs_devices_and_isolates_outputs(tmp_path):
+    rigs, limits = make_config(tmp_path, [make_rig('rig1', 1), make_rig('rig2', 2)])
+    assert validate_rigs(rigs, limits) == []
+    assert [rig['plan']['stage']['serial_no'] for rig in rigs] == ['271', '272']
+    assert [rig['plan']['camera']['serial_no'] for rig in rigs] == ['411', '412']
+    # both rigs share the plan, but write to their own subfolders
+    assert [rig['plan']['output']['path'] for rig in rigs] == [os.path.join('data', name) for name in ('rig1', 'rig2')]
+    assert limits['disk_mb_s'] is None
+    assert limits['max_writers'] >= 1
+
+
+def test_validate_rigs_reports_duplicates(tmp_path):
+    rig = make_rig('rig1', 1)
+    rigs, limits = make_config(tmp_path, [rig, dict(rig, stage_serial='272')])
+    errors = validate_rigs(rigs, limits)
+    assert 'name rig1 used by more than one rig' in errors
+    assert 'camera_serial 411 used by more than one rig' in errors
+    assert not any(error.startswith('stage_serial') for error in errors)
+
+
+def test_validate_rigs_reports_missing_keys_and_unreadable_plan(tmp_path):
+    rig = make_rig('rig1', 1)
+    del rig['stage_serial']
+    rigs, limits = make_config(tmp_path, [rig, dict(make_rig('rig2', 2), plan='missing.json')])
+    errors = validate_rigs(rigs, limits)
+    assert errors[0] == 'rig1: missing stage_serial'
+    assert errors[1].startswith('rig2: cannot read the plan')
+
+
+def test_validate_rigs_reports_bad_limits(tmp_path):
+    rigs, limits = make_config(tmp_path, [make_rig('rig1', 1)], {'disk_mb_s': -1, 'max_writers': 0})
+    assert validate_rigs(rigs, limits) == ['limits: disk_mb_s must be a positive number or null, got -1',
+                                           'limits: max_writers must be a positive integer, got 0']
+
+
+def test_validate_rigs_checks_connected_devices(tmp_path):
+    rigs, limits = make_config(tmp_path, [make_rig('rig1', 1)])
+    assert validate_rigs(rigs, limits, ['411'], ['271']) == []
+    assert validate_rigs(rigs, limits, [], []) == ['rig1: camera #411 not connected',
+                                                   'rig1: KDC101 #271 not connected']
+
+
+def test_disk_throttle_limits_bandwidth():
+    throttle = DiskThrottle(1e6)
+    t_start = time.monotonic()
+    for _ in range(4):
+        throttle.consume(100000)
+    # the first 100 kB are free, the next 300 kB take 0.3 s at 1 MB/s
+    assert time.monotonic() - t_start == pytest.approx(0.3, abs=0.1)
+
+
+def test_rig_limits_record_wait_per_thread(tmp_path):
+    filename = str(tmp_path / 'frame')
+
+    def save(image, filepath, filename_=None, file_format='png'):
+        time.sleep(0.05)
+        with open(filename, 'wb') as f:
+            f.write(b'x')
+        return filename
+
+    limits = RigLimits(save, 1)
+    results = []
+
+    def worker():
+        limits.pop_wait()
+        t_start = time.perf_counter()
+        for _ in range(2):
+            with limits.cpu():
+                time.sleep(0.05)
+            limits.save(None, str(tmp_path))
+        results.append(time.perf_counter() - t_start - limits.pop_wait())
+
+    workers = [threading.Thread(target=worker) for _ in range(3)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    # every worker spends 0.2 s converting and saving; the rest is waiting for the other workers
+    assert results == pytest.approx([0.2] * 3, abs=0.05)
+
+
+@pytest.mark.parametrize('name', [5, '', '../x', 'a/b', 'a\\b'])
+def test_validate_rigs_rejects_names_unusable_in_paths(tmp_path, name):
+    rigs, limits = make_config(tmp_path, [dict(make_rig('rig1', 1), name=name)])
+    errors = validate_rigs(rigs, limits)
+    assert len(errors) == 1
+    assert errors[0].startswith(f'rig {name!r}: name must')
+    assert 'timing_log' not in rigs[0]
+    assert rigs[0]['plan'] == 'plan.json'
+
+
+def test_validate_rigs_reports_wrong_types(tmp_path):
+    (tmp_path / 'plan.json').write_text(json.dumps(PLAN))
+    (tmp_path / 'list.json').write_text(json.dumps([PLAN]))
+    rigs = [7, dict(make_rig('rig1', 1), plan=3), dict(make_rig('rig2', 2), plan='list.json'),
+            {'name': 'rig3', 'camera_serial': '413', 'stage_serial': '273'}]
+    config = {'limits': None, 'rigs': rigs}
+    (tmp_path / 'rigs.json').write_text(json.dumps(config))
+    rigs, limits = load_rigs(str(tmp_path / 'rigs.json'))
+    errors = validate_rigs(rigs, limits)
+    assert errors[:2] == ['limits must be an object, got None', 'rig 0: must be an object, got 7']
+    assert errors[2] == 'rig1: cannot read the plan: plan must be a file name, got 3'
+    assert errors[3].startswith('rig2: cannot read the plan') and errors[3].endswith('a plan must be a JSON object')
+    assert errors[4] == 'rig3: missing plan'
+    rigs, limits = make_config(tmp_path, {'rig1': make_rig('rig1', 1)})
+    assert validate_rigs(rigs, limits) == [f'rigs must be a list, got {rigs!r}']
+
+
+def test_load_rigs_rejects_config_which_is_not_an_object(tmp_path):
+    (tmp_path / 'rigs.json').write_text(json.dumps([make_rig('rig1', 1)]))
+    with pytest.raises(ValueError):
+        load_rigs(str(tmp_path / 'rigs.json'))
+
+
+def test_load_rigs_resolves_timing_logs_against_config_folder(tmp_path):
+    rigs, limits = make_config(tmp_path, [make_rig('rig1', 1), dict(make_rig('rig2', 2), timing_log='logs/t.jsonl'),
+                                          dict(make_rig('rig3', 3), timing_log=None)])
+    assert rigs[0]['timing_log'] == os.path.join(str(tmp_path), 'scan_timing_rig1.jsonl')
+    assert rigs[1]['timing_log'] == os.path.join(str(tmp_path), 'logs/t.jsonl')
+    assert validate_rigs(rigs, limits) == ['rig3: timing_log must be a file name, got None']
@@ -0,0 +1,167 @@
+"""
+Tests of the scan plan functions which do not need any device. Run with: python -m pytest
+"""
+
+import itertools
+import json
+
+import pytest
+
+from scan_plan import *
+
+
+def make_plan(tmp_path, **sections):
+    """Write a valid plan, with the given sections replaced, and load it with load_plan."""
+    plan = {
+        'stage': {'serial_no': '27601295'},
+        'camera': {'exposure_us': 16000.0},
+        'output': {'path': 'data'},
+        'scans': [{'name': 'coarse', 'start': 5.0, 'step': 0.0008, 'n': 100}],
+    }
+    plan.update(sections)
+    filepath = tmp_path / 'plan.json'
+    filepath.write_text(json.dumps(plan))
+    return load_plan(str(filepath))
+
+
+def test_scan_positions_range_with_n():
+    assert scan_positions({'start': 1.0, 'step': 0.5, 'n': 3}) == [1.0, 1.5, 2.0]
+
+
+def test_scan_positions_range_with_stop_is_rounded():
+    positions = scan_positions({'start': 5.0, 'step': 0.0008, 'stop': 5.08})
+    assert len(positions) == 101
+    assert positions[-1] == 5.08
+    assert positions[37] == 5.0296
+
+
+def test_scan_positions_z_list_keeps_order():
+    assert scan_positions({'z': [7.3, 7.1, 7.15]}) == [7.3, 7.1, 7.15]
+
+
+def test_validate_plan_accepts_valid_plan(tmp_path):
+    assert validate_plan(make_plan(tmp_path)) == []
+
+
+def test_validate_plan_reports_positions_outside_stage_range(tmp_path):
+    plan = make_plan(tmp_path, scans=[{'name': 'far', 'z': [24.0, 25.5]}])
+    errors = validate_plan(plan)
+    assert len(errors) == 1
+    assert errors[0].startswith('far: 1 position(s) outside')
+
+
+def test_validate_plan_reports_wrong_types_without_raising(tmp_path):
+    plan = make_plan(tmp_path, stage={'serial_no': '1', 'start_pos': '3'}, camera={'exposure_us': '1000'},
+                     scans=[{'name': 's', 'z': [1.0], 'settle_s': '1', 'burst': 'a'}, {'name': 'r', 'start': 1.0}])
+    errors = validate_plan(plan)
+    assert 'stage: start_pos must be a number, got \'3\'' in errors
+    assert 'camera: exposure_us must be a number, got \'1000\'' in errors
+    assert 's: burst must be an integer, got \'a\'' in errors
+    assert 's: settle_s must be a number, got \'1\'' in errors
+    assert any(error.startswith('r: a scan needs') for error in errors)
+
+
+def test_validate_plan_checks_exposure_range(tmp_path):
+    plan = make_plan(tmp_path)
+    assert validate_plan(plan, (10.0, 20000.0)) == []
+    assert validate_plan(plan, (10.0, 1000.0)) == ['camera: exposure_us 16000.0 outside camera range 10.0-1000.0 us']
+
+
+def test_validate_plan_requires_start_pos_without_homing(tmp_path):
+    plan = make_plan(tmp_path, stage={'serial_no': '1', 'homing': False})
+    assert validate_plan(plan) == ['stage: start_pos is required when homing is false']
+    plan = make_plan(tmp_path, stage={'serial_no': '1', 'homing': False, 'start_pos': 4.0})
+    assert validate_plan(plan) == []
+
+
+def test_order_scans_is_optimal():
+    scans = [{'name': 'a', 'z': [20.0, 21.0]}, {'name': 'b', 'z': [3.0, 1.0]}, {'name': 'c', 'z': [10.0]},
+             {'name': 'd', 'start': 15.0, 'step': -0.5, 'n': 5}, {'name': 'e', 'z': [0.5, 2.0]}]
+    best = min(scans_travel(order, 4.0) for order in itertools.permutations(scans))
+    ordered = order_scans(scans, 4.0)
+    assert sorted(scan['name'] for scan in ordered) == sorted(scan['name'] for scan in scans)
+    assert scans_travel(ordered, 4.0) == pytest.approx(best)
+
+
+def test_order_scans_handles_long_scans():
+    scans = [{'name': f's{i}', 'start': 2.0 * i, 'step': 0.0008, 'n': 2000} for i in (5, 1, 9, 3, 7, 0, 8, 2, 6, 4)]
+    ordered = order_scans(scans, 0.0)
+    assert [scan['name'] for scan in ordered] == [f's{i}' for i in range(10)]
+
+
+def test_order_scans_nearest_neighbour_for_many_scans():
+    scans = [{'name': f's{i}', 'z': [float(i)]} for i in reversed(range(MAX_EXACT_ORDERING + 3))]
+    assert [scan['name'] for scan in order_scans(scans, 0.0)] == [f's{i}' for i in range(MAX_EXACT_ORDERING + 3)]
+
+
+def test_fit_timing_model_without_records_is_default():
+    assert fit_timing_model([]) == DEFAULT_TIMING_MODEL
+
+
+def test_fit_timing_model_recovers_move_frame_and_size():
+    records = [{'move_mm': d, 'move_s': 0.2 + d / 2.0, 'settle_s': 1.0, 'frames': 2, 'frame_s': 0.4,
+                'exposure_us': 16000.0, 'pixels': 100, 'bytes': 240, 'format': 'png'} for d in (0.1, 1.0, 2.5, 4.0)]
+    model = fit_timing_model(records)
+    assert model['move_speed_mm_s'] == pytest.approx(2.0)
+    assert model['move_overhead_s'] == pytest.approx(0.2)
+    assert model['frame_overhead_s'] == pytest.approx(0.384)
+    assert model['bytes_per_pixel']['png'] == pytest.approx(1.2)
+    assert model['bytes_per_pixel']['bmp'] == DEFAULT_TIMING_MODEL['bytes_per_pixel']['bmp']
+
+
+def test_fit_timing_model_with_equal_moves_keeps_default_speed():
+    records = [{'move_mm': 1.0, 'move_s': 1.0, 'settle_s': 1.0, 'frames': 1, 'frame_s': 0.3, 'exposure_us': 0.0,
+                'pixels': 100, 'bytes': 100, 'format': 'png'}] * 3
+    model = fit_timing_model(records)
+    assert model['move_speed_mm_s'] == DEFAULT_TIMING_MODEL['move_speed_mm_s']
+    assert model['move_overhead_s'] == pytest.approx(1.0 - 1.0 / DEFAULT_TIMING_MODEL['move_speed_mm_s'])
+
+
+def test_load_timing_records_skips_invalid_lines(tmp_path, capsys):
+    record = {'move_mm': 1.0, 'move_s': 0.7, 'settle_s': 1.0, 'frames': 1, 'frame_s': 0.3, 'exposure_us': 1000.0,
+              'pixels': 100, 'bytes': 150, 'format': 'png'}
+    filepath = tmp_path / 'timing.jsonl'
+    filepath.write_text(json.dumps(record) + '\n'
+                        + json.dumps({'move_mm': 1.0}) + '\n'
+                        + json.dumps(dict(record, frame_s='0.3')) + '\n'
+                        + '\n'
+                        + json.dumps(record)[:20] + '\n')
+    assert load_timing_records(str(filepath)) == [record]
+    assert 'skipped 3 invalid line(s)' in capsys.readouterr().out
+
+
+def test_estimate_plan_includes_move_from_home_to_start_pos(tmp_path):
+    model = dict(DEFAULT_TIMING_MODEL, move_overhead_s=0.5, move_speed_mm_s=2.0, frame_overhead_s=0.0)
+    scans = [{'name': 's', 'z': [10.0, 10.0, 11.0], 'burst': 1, 'settle_s': 0.0}]
+    plan = make_plan(tmp_path, stage={'serial_no': '1', 'start_pos': 10.0}, camera={'exposure_us': 0.0}, scans=scans)
+    duration, _, n_frames, travel = estimate_plan(plan, plan['scans'], model)
+    # home -> 10 mm, then 10 -> 11 mm; no move between the equal positions
+    assert travel == pytest.approx(11.0)
+    assert duration == pytest.approx(2 * 0.5 + 11.0 / 2.0)
+    assert n_frames == 3
+    plan = make_plan(tmp_path, stage={'serial_no': '1', 'homing': False, 'start_pos': 10.0},
+                     camera={'exposure_us': 0.0}, scans=scans)
+    assert estimate_plan(plan, plan['scans'], model)[3] == pytest.approx(1.0)
+
+
+def test_validate_plan_checks_range_fields(tmp_path):
+    plan = make_plan(tmp_path, scans=[{'name': 'a', 'start': '5', 'step': '0.1', 'n': 3},
+                                      {'name': 'b', 'start': 5.0, 'step': 0.1, 'n': 2.7},
+                                      {'name': 'c', 'start': 5.0, 'step': 0.0, 'stop': 6.0},
+                                      {'name': 'd', 'z': [5.0, '6']}])
+    assert validate_plan(plan) == ["a: start must be a number, got '5'", "a: step must be a number, got '0.1'",
+                                   'b: n must be an integer, got 2.7', 'c: step must not be 0',
+                                   "d: z must be a list of numbers, got [5.0, '6']"]
+
+
+def test_validate_plan_limits_number_of_positions(tmp_path):
+    plan = make_plan(tmp_path, scans=[{'name': 'a', 'start': 0.0, 'step': 1e-9, 'stop': 25.0},
+                                      {'name': 'b', 'start': 0.0, 'step': 0.001, 'n': 10 ** 10}])
+    assert validate_plan(plan) == [f'a: 25000000001 positions, more than {MAX_SCAN_POSITIONS}',
+                                   f'b: 10000000000 positions, more than {MAX_SCAN_POSITIONS}']
+
+
+@pytest.mark.parametrize('sections', [{'stage': None}, {'camera': []}, {'scans': {}}, {'scans': [1.0]}])
+def test_load_plan_rejects_wrong_structure(tmp_path, sections):
+    with pytest.raises(ValueError):
+        make_plan(tmp_path, **sections)